@@ -0,0 +1,121 @@
+"""Output encoders shared by the render script and preprocess.py
+
+An encoder is a small dict describing how one output stream (images or
+label masks) is written to disk: its format, file extension and
+compression level. Compression levels are zlib levels (0-9) as used by
+cv2; they are mapped to Blender's percentage scale for the compositor.
+"""
+
+from pathlib import Path
+import numpy as np
+
+try:  # cv2 is not needed to configure Blender file output slots
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+def _write_png(path, img, compression):
+    params = [] if compression is None else [cv2.IMWRITE_PNG_COMPRESSION, int(compression)]
+    return cv2.imwrite(str(path), img, params)
+
+def _write_webp(path, img, compression):
+    # cv2 writes lossless WebP for any quality above 100
+    return cv2.imwrite(str(path), img, [cv2.IMWRITE_WEBP_QUALITY, 101])
+
+def _write_raw(path, img, compression):
+    np.save(str(path), np.ascontiguousarray(img, dtype=np.uint8), allow_pickle=False)
+    return True
+
+
+# registered encoders: format name -> (file extension, write function)
+ENCODERS = {
+    "png": (".png", _write_png),
+    "webp": (".webp", _write_webp),
+    "raw": (".npy", _write_raw),
+}
+
+
+def get_encoder(fmt="png", compression=None, fast=False):
+    """Build an encoder for one output stream
+
+    Args:
+        - fmt: registered format name (png, webp or raw)
+        - compression: zlib level 0-9 for png, None keeps the library default
+        - fast: fast-write mode for scratch data, png and webp are written
+            as uncompressed png, trading disk space for throughput
+
+    Returns:
+        - encoder: dict with format, ext, and compression
+    """
+    if fmt not in ENCODERS:
+        raise ValueError(f"Unknown output format {fmt}, expected one of {list(ENCODERS)}")
+    if compression is not None and not 0 <= int(compression) <= 9:
+        raise ValueError(f"Compression level must be in 0-9, got {compression}")
+    if fast and fmt != "raw":
+        fmt, compression = "png", 0
+    return {"format": fmt, "ext": ENCODERS[fmt][0], "compression": compression}
+
+
+def write_image(encoder, path, img):
+    """Write an image with an encoder
+
+    Args:
+        - encoder: encoder from get_encoder
+        - path: output path, its suffix is replaced by the encoder extension
+        - img: uint8 image array
+
+    Returns:
+        - path of the written file, or None if writing failed
+    """
+    out_path = Path(path).with_suffix(encoder["ext"])
+    # outputs may be hardlinks to renders or cache entries, never write through them
+    if out_path.exists():
+        out_path.unlink()
+    write = ENCODERS[encoder["format"]][1]
+    if not write(out_path, img, encoder["compression"]):
+        return None
+    return out_path
+
+
+def configure_file_slot(slot, encoder, color_mode=None):
+    """Apply an encoder to a Blender compositor File Output slot
+
+    Blender cannot dump raw arrays, so raw streams are rendered as
+    uncompressed png and can be converted by preprocess.py.
+
+    Args:
+        - slot: file slot of the File Output node
+        - encoder: encoder from get_encoder
+        - color_mode: optional Blender colour mode (BW, RGB, RGBA)
+    """
+    slot.use_node_format = False
+    fmt = slot.format
+    if encoder["format"] == "webp":
+        fmt.file_format = 'WEBP'
+        fmt.quality = 100  # lossless
+    else:
+        fmt.file_format = 'PNG'
+        compression = 0 if encoder["format"] == "raw" else encoder["compression"]
+        if compression is not None:
+            fmt.compression = round(int(compression) * 100 / 9)
+    fmt.color_depth = '8'
+    if color_mode is not None:
+        fmt.color_mode = color_mode
+
+
+def encoders_from_config(cfg):
+    """Build image and mask encoders from the output_format config section
+
+    Returns:
+        - (image_encoder, mask_encoder), or None if the section is missing
+    """
+    out_cfg = cfg.get("output_format")
+    if not out_cfg:
+        return None
+    fast = out_cfg.get("fast_write", False)
+    return tuple(
+        get_encoder(out_cfg.get(stream, {}).get("format", "png"),
+                    out_cfg.get(stream, {}).get("compression"), fast)
+        for stream in ("image", "mask")
+    )
@@ -0,0 +1,179 @@
+"""Read and validate PNG and WebP image headers without decoding the image data"""
+
+import os
+import csv
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# a complete png ends with an empty IEND chunk
+PNG_IEND = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+# png colour type -> number of channels
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# scanned file suffixes, the formats the render script can write
+SCAN_SUFFIXES = (".png", ".webp")
+REPORT_COLUMNS = ["path", "valid", "error", "width", "height", "channels", "bit_depth", "file_size"]
+
+
+def read_png_header(path):
+    """Read the IHDR chunk of a PNG file
+
+    Args:
+        - path: path to png file
+
+    Returns:
+        - dict with width, height, bit_depth and colour_type, or None if the
+            file is not a png or the header is incomplete
+    """
+    with open(path, "rb") as f:
+        head = f.read(33)  # signature (8) + IHDR length/type (8) + IHDR data (13) + crc (4)
+    if len(head) < 33 or head[:8] != PNG_SIGNATURE or head[12:16] != b"IHDR":
+        return None
+    width, height, bit_depth, colour_type = struct.unpack(">IIBB", head[16:26])
+    return {
+        "width": width,
+        "height": height,
+        "bit_depth": bit_depth,
+        "colour_type": colour_type,
+    }
+
+
+def scan_png(path, size=None, channels=None):
+    """Validate a png file from its header and trailer only
+
+    Args:
+        - path: path to png file
+        - size: required (width, height), None accepts any size
+        - channels: accepted channel counts, None accepts any
+
+    Returns:
+        - dict with the REPORT_COLUMNS fields, error is empty for valid files
+    """
+    result = {"path": str(path), "valid": False, "error": "", "width": -1, "height": -1,
+              "channels": -1, "bit_depth": -1, "file_size": -1}
+    try:
+        with open(path, "rb") as f:
+            head = f.read(33)
+            result["file_size"] = file_size = os.fstat(f.fileno()).st_size
+            if file_size >= 45:  # signature + IHDR + IEND
+                f.seek(-12, os.SEEK_END)
+                tail = f.read(12)
+            else:
+                tail = b""
+    except OSError as e:
+        result["error"] = f"unreadable: {e}"
+        return result
+    if len(head) < 33 or head[:8] != PNG_SIGNATURE or head[12:16] != b"IHDR":
+        result["error"] = "not a png"
+        return result
+    width, height, bit_depth, colour_type = struct.unpack(">IIBB", head[16:26])
+    result.update(width=width, height=height, bit_depth=bit_depth,
+                  channels=PNG_CHANNELS.get(colour_type, -1))
+    if tail != PNG_IEND:
+        result["error"] = "truncated"
+    elif size is not None and (width, height) != tuple(size):
+        result["error"] = f"invalid size {width}x{height}"
+    elif channels is not None and result["channels"] not in channels:
+        result["error"] = f"invalid channels {result['channels']}"
+    else:
+        result["valid"] = True
+    return result
+
+
+def read_webp_header(head):
+    """Parse the RIFF header and first chunk of a WebP file
+
+    Args:
+        - head: first 30 bytes of the file
+
+    Returns:
+        - (riff_size, width, height, channels), or None if the file is not a
+            supported WebP (VP8, VP8L or VP8X)
+    """
+    if len(head) < 30 or head[:4] != b"RIFF" or head[8:12] != b"WEBP":
+        return None
+    riff_size = struct.unpack("<I", head[4:8])[0]
+    chunk = head[12:16]
+    if chunk == b"VP8L" and head[20] == 0x2F:  # lossless
+        bits = struct.unpack("<I", head[21:25])[0]
+        width, height = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        channels = 4 if bits >> 28 & 1 else 3
+    elif chunk == b"VP8 " and head[23:26] == b"\x9d\x01\x2a":  # lossy
+        width, height = struct.unpack("<HH", head[26:30])
+        width, height, channels = width & 0x3FFF, height & 0x3FFF, 3
+    elif chunk == b"VP8X":  # extended
+        width = int.from_bytes(head[24:27], "little") + 1
+        height = int.from_bytes(head[27:30], "little") + 1
+        channels = 4 if head[20] & 0x10 else 3
+    else:
+        return None
+    return riff_size, width, height, channels
+
+
+def scan_webp(path, size=None, channels=None):
+    """Validate a WebP file from its RIFF header only
+
+    Args:
+        - path: path to webp file
+        - size: required (width, height), None accepts any size
+        - channels: accepted channel counts, None accepts any
+
+    Returns:
+        - dict with the REPORT_COLUMNS fields, error is empty for valid files
+    """
+    result = {"path": str(path), "valid": False, "error": "", "width": -1, "height": -1,
+              "channels": -1, "bit_depth": -1, "file_size": -1}
+    try:
+        with open(path, "rb") as f:
+            head = f.read(30)
+            result["file_size"] = file_size = os.fstat(f.fileno()).st_size
+    except OSError as e:
+        result["error"] = f"unreadable: {e}"
+        return result
+    header = read_webp_header(head)
+    if header is None:
+        result["error"] = "not a webp"
+        return result
+    riff_size, width, height, n_channels = header
+    result.update(width=width, height=height, bit_depth=8, channels=n_channels)
+    # the riff size covers everything after the 8 byte riff header, chunks are padded to even sizes
+    if file_size < riff_size + 8:
+        result["error"] = "truncated"
+    elif size is not None and (width, height) != tuple(size):
+        result["error"] = f"invalid size {width}x{height}"
+    elif channels is not None and n_channels not in channels:
+        result["error"] = f"invalid channels {n_channels}"
+    else:
+        result["valid"] = True
+    return result
+
+
+def scan_dir(directory, size=None, channels=None, workers=16, webp_channels=None):
+    """Validate all png and webp files in a directory from their headers
+
+    Args:
+        - directory: folder with png files
+        - size: required (width, height), None accepts any size
+        - channels: accepted channel counts, None accepts any
+        - workers: number of threads reading headers
+        - webp_channels: accepted channel counts of webp files, None uses channels
+
+    Returns:
+        - list of scan_png and scan_webp results, empty if the directory does not exist
+    """
+    if not os.path.isdir(directory):
+        return []
+    with os.scandir(directory) as it:
+        paths = [e.path for e in it if e.name.endswith(SCAN_SUFFIXES) and e.is_file()]
+    webp_channels = channels if webp_channels is None else webp_channels
+    scan = lambda p: scan_webp(p, size, webp_channels) if p.endswith(".webp") else scan_png(p, size, channels)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(scan, paths, chunksize=256))
+
+
+def write_report(results, path):
+    """Write scan results to a csv validation report"""
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(results)
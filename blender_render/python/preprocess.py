@@ -4,6 +4,7 @@ import sys
 import os
 import os.path as osp
 from pathlib import Path
+import shutil
 import logging
 from tqdm.contrib.logging import logging_redirect_tqdm
 import argparse
@@ -12,8 +13,17 @@ from tqdm import tqdm
 import numpy as np
 import cv2
 
+from encoders import ENCODERS, get_encoder, write_image
+from png_header import read_png_header, scan_dir, write_report
+from sample_index import new_index, add_index_row, save_index
+
 logger = logging.getLogger(__name__)
 
+# file formats the render script can write
+RENDER_SUFFIXES = (".png", ".webp")
+# output image size (width, height), matches the render resolution in utils.setup
+TARGET_SIZE = (1920, 1080)
+
 
 def combine_masks(anomaly_mask, fb_mask) -> np.ndarray:
     """Combine anomaly mask and fb mask into 3 class mask"""
@@ -22,6 +32,201 @@ def combine_masks(anomaly_mask, fb_mask) -> np.ndarray:
     final_mask[anomaly_mask == 255] = 2  # grayscale colour of anomaly
     return final_mask
 
+def link_or_copy(src, dst):
+    """Hardlink src to dst, falling back to a kernel-side copy across filesystems"""
+    dst = Path(dst)
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)  # uses sendfile on linux
+    return dst
+
+def can_passthrough(src, encoder, size=TARGET_SIZE, colour_type=2):
+    """Check from the png header only if src can be linked to the output unchanged
+    
+    Args:
+        - src: path to rendered image
+        - encoder: output encoder of the image stream
+        - size: required (width, height) of the output
+        - colour_type: required png colour type, 2 for 8-bit RGB as written by
+            cv2 for decoded images, 0 for single channel label maps
+    
+    Returns:
+        - bool: True if src is an 8-bit png of the required size and colour type,
+            and the output is png without a requested compression level
+    """
+    if encoder["format"] != "png" or encoder["compression"] is not None or Path(src).suffix != ".png":
+        return False
+    header = read_png_header(src)
+    return header is not None and (header["width"], header["height"]) == tuple(size) \
+        and header["colour_type"] == colour_type and header["bit_depth"] == 8
+
+def image_size(path, image=None):
+    """(width, height) of an image, from the decoded image or the png header"""
+    if image is not None:
+        return image.shape[1], image.shape[0]
+    header = read_png_header(path) if Path(path).suffix == ".png" else None
+    if header is not None:
+        return header["width"], header["height"]
+    height, width = cv2.imread(str(path), cv2.IMREAD_UNCHANGED).shape[:2]
+    return width, height
+
+def resize_labels(mask, size, classes=(0, 1, 2)):
+    """Resize a label mask without blending its classes
+    
+    Integer downsampling factors take the most frequent class of each block,
+    ties going to the higher class so thin anomalies survive. Other values,
+    such as anti-aliased mask edges, are not counted, and blocks without any
+    class pixel get the first class. Other sizes use nearest neighbour
+    interpolation.
+    
+    Args:
+        - mask: label mask, single or 3 channel
+        - size: output (width, height)
+        - classes: mask values in ascending order, (0, 255) for legacy fb masks
+    
+    Returns:
+        - resized mask
+    """
+    height, width = mask.shape[:2]
+    if (width, height) == tuple(size):
+        return mask
+    if width % size[0] or height % size[1]:
+        return cv2.resize(mask, tuple(size), interpolation=cv2.INTER_NEAREST)
+    fx, fy = width // size[0], height // size[1]
+    blocks = mask.reshape(size[1], fy, size[0], fx, *mask.shape[2:])
+    # running argmax over the classes, one block count array at a time
+    best = np.full((size[1], size[0], *mask.shape[2:]), classes[0], dtype=mask.dtype)
+    best_count = np.zeros(best.shape, dtype=np.int32)
+    for value in classes:
+        count = (blocks == value).sum(axis=(1, 3), dtype=np.int32)
+        better = (count > best_count) | ((count == best_count) & (count > 0))
+        best[better] = value
+        best_count[better] = count[better]
+    return best
+
+def save_levels(name, camera, image_src, levels, encoders, args, image=None,
+                mask_src=None, mask=None, mask_flags=cv2.IMREAD_COLOR, to_labels=None):
+    """Save an image and its mask at every output level from at most one decode of each
+    
+    Levels matching the size of a png source are linked without decoding when
+    passthrough is enabled. Images are resized with INTER_AREA and masks with
+    resize_labels.
+    
+    Args:
+        - name: output file name
+        - camera: camera folder name
+        - image_src: path to rendered image
+        - levels: output levels from make_levels
+        - encoders: (image, mask) output encoders
+        - args: parsed arguments
+        - image: decoded image, read from image_src when a level needs it
+        - mask_src: path to a mask that can be saved unchanged, None if mask is computed
+        - mask: decoded mask, read from mask_src when a level needs it
+        - mask_flags: cv2 imread flags of mask_src
+        - to_labels: converts a mask to the 3 class labels of the index, None if it already is
+    
+    Returns:
+        - bool: True if the image and mask were saved at every level
+    """
+    image_encoder, mask_encoder = encoders
+    orig_size = None
+    # png colour type the mask is decoded to, only such masks are linked unchanged
+    mask_colour_type = 2 if mask_flags == cv2.IMREAD_COLOR else 0
+    # raw fb masks are 0/255, computed masks and label maps are 3 class masks
+    mask_classes = (0, 255) if to_labels is not None else (0, 1, 2)
+    for level in levels:
+        size, cam_output_dir = level["size"], level["dir"] / camera
+        #* image, linked if it is already a png at the level size
+        if args.passthrough and can_passthrough(image_src, image_encoder, size):
+            image_path = link_or_copy(image_src, cam_output_dir / "images" / name)
+        else:
+            if image is None:
+                image = cv2.imread(str(image_src))
+            resized = image if image.shape[:2] == size[::-1] else \
+                cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+            image_path = write_image(image_encoder, cam_output_dir / "images" / name, resized)
+        #* mask, labels are never blended
+        level_mask = None
+        if mask_src is not None and args.passthrough and \
+                can_passthrough(mask_src, mask_encoder, size, mask_colour_type):
+            mask_path = link_or_copy(mask_src, cam_output_dir / "masks" / name)
+        else:
+            if mask is None:
+                mask = cv2.imread(str(mask_src), mask_flags)
+            level_mask = resize_labels(mask, size, mask_classes)
+            mask_path = write_image(mask_encoder, cam_output_dir / "masks" / name, level_mask)
+        if not (image_path and mask_path):
+            return False
+        if level["index"] is not None:
+            if level_mask is None:
+                if mask is None:
+                    mask = cv2.imread(str(mask_src), mask_flags)
+                level_mask = resize_labels(mask, size, mask_classes)
+            if orig_size is None:
+                orig_size = image_size(image_src, image)
+            labels = level_mask if to_labels is None else to_labels(level_mask)
+            add_index_row(level["index"], image_path.relative_to(level["dir"]), camera, labels, orig_size)
+    return True
+
+def make_levels(output_dir, sizes, index=False):
+    """Output levels, one output tree per size
+    
+    A single size is written directly to output_dir, several sizes to
+    output_dir/<width>x<height>.
+    
+    Args:
+        - output_dir: output folder
+        - sizes: list of output (width, height)
+        - index: add an empty sample index to every level
+    
+    Returns:
+        - list of dicts with size, dir and index of each level
+    """
+    return [{
+        "size": tuple(size),
+        "dir": output_dir if len(sizes) == 1 else output_dir / f"{size[0]}x{size[1]}",
+        "index": new_index() if index else None,
+    } for size in sizes]
+
+def parse_size(size):
+    """Parse an image size given as <width>x<height>"""
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+def prescan_camera(cam, anomaly, mask_layout="legacy", workers=16):
+    """Validate all png and webp renders of a camera folder from their headers
+    
+    Anomalous renders must be at the target size, normal renders of any size are resized.
+    
+    Args:
+        - cam: camera folder with render subfolders
+        - anomaly: anomalous (True) or normal (False) renders
+        - mask_layout: legacy fb and anomaly masks or single channel label maps
+        - workers: number of threads reading headers
+    
+    Returns:
+        - results: scan results of all png and webp files
+        - rejected: set of paths of invalid files
+    """
+    size = TARGET_SIZE if anomaly else None
+    if mask_layout == "label":
+        masks = {"label": (1,)}
+    elif anomaly:
+        masks = {"anomaly_mask": (1, 3, 4), "fb_mask": (1, 3, 4)}
+    else:
+        masks = {"fb_mask": (1, 3, 4)}
+    streams = {"anomaly" if anomaly else "normal": (3, 4), **masks}
+    results = []
+    for name, channels in streams.items():
+        # webp has no grayscale, label maps are decoded to a single channel
+        webp_channels = (3, 4) if name == "label" else None
+        results.extend(scan_dir(cam / name, size, channels, workers, webp_channels))
+    rejected = {r["path"] for r in results if not r["valid"]}
+    return results, rejected
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input', type=str, help='path to input directory with camera folders')
@@ -31,10 +236,160 @@ def parse_args():
     parser.add_argument("--anomaly", action="store_true", 
                         default=False, help="normal or anomaly dataset")
     parser.add_argument('--min_pixel', type=int, default=2000, help='minimum pixel size of anomaly')
+    parser.add_argument('--image_format', type=str, default='png', choices=list(ENCODERS),
+                        help='output format of images')
+    parser.add_argument('--mask_format', type=str, default='png', choices=list(ENCODERS),
+                        help='output format of masks')
+    parser.add_argument('--image_compression', type=int, default=None,
+                        help='png compression level (0-9) of images, default is the cv2 default')
+    parser.add_argument('--mask_compression', type=int, default=None,
+                        help='png compression level (0-9) of masks, default is the cv2 default')
+    parser.add_argument('--fast_write', action='store_true', default=False,
+                        help='write uncompressed png for scratch data')
+    parser.add_argument('--no_passthrough', dest='passthrough', action='store_false', default=True,
+                        help='always decode and re-encode images, even if they are already at the target size')
+    parser.add_argument('--mask_layout', type=str, default='legacy', choices=['legacy', 'label'],
+                        help='render mask layout, separate fb and anomaly masks or single channel label maps')
+    parser.add_argument('--no_prescan', dest='prescan', action='store_false', default=True,
+                        help='skip the header-only validation of all renders before decoding')
+    parser.add_argument('--scan_only', action='store_true', default=False,
+                        help='only write the validation report, do not process images')
+    parser.add_argument('--workers', type=int, default=16, help='number of threads for the header scan')
+    parser.add_argument('--index', action='store_true', default=False,
+                        help='write a per-sample statistics index to index.npz in the output directory')
+    parser.add_argument('--sizes', type=parse_size, nargs='+', default=[TARGET_SIZE],
+                        help='output sizes as <width>x<height>, several sizes are written to one output folder each')
     args = parser.parse_args()
     return args
 
 
+def process_anomaly_camera(cam, levels, args, encoders, rejected=frozenset()):
+    """Verify anomalous renders of a camera and save images with their 3 class masks
+    
+    Args:
+        - cam: camera folder with render subfolders
+        - levels: output levels from make_levels
+        - args: parsed arguments
+        - encoders: (image, mask) output encoders
+        - rejected: paths rejected by the header scan
+    
+    Returns:
+        - number of saved samples
+    """
+    image_encoder, mask_encoder = encoders
+    label_map = args.mask_layout == "label"
+    cnt = 0
+    # anomaly images and anomaly mask input folders
+    anomaly_input_dir = cam / "anomaly"
+    mask_input_dir = cam / ("label" if label_map else "anomaly_mask")
+    
+    # iterate through saved anomaly masks
+    for mask in mask_input_dir.iterdir():
+        if mask.suffix in RENDER_SUFFIXES:
+            anomaly_input = anomaly_input_dir / mask.name  # anomalous image
+            fb_input = str(cam / "fb_mask" / mask.name)
+            inputs = [str(mask), str(anomaly_input)] + ([] if label_map else [fb_input])
+            if rejected.intersection(inputs):
+                continue
+            #* Read anomaly mask and verify shape
+            try:
+                if label_map:  # single channel label map, anomaly pixels are 2
+                    mask_img = cv2.imread(str(mask), cv2.IMREAD_GRAYSCALE)
+                    expected_shape = (1080, 1920)
+                else:
+                    mask_img = cv2.imread(str(mask))
+                    expected_shape = (1080, 1920, 3)
+                if mask_img.shape != expected_shape:
+                    logging.error(f"Invalid shape {mask_img.shape} for {mask}")
+                    continue
+            except Exception as e:
+                logging.error(f"Failed to read {mask}")
+                continue
+            # Check number of anomalous pixels before reading the image, if more than min pixels save
+            n_anomaly = np.sum(mask_img == 2) if label_map else np.sum(mask_img == 255) // 3
+            if n_anomaly <= args.min_pixel: 
+                logging.info(f"Skipping {mask.name}")
+                continue
+            #* read anomaly image and foreground/backgrond mask, combine masks
+            try:
+                if args.passthrough and can_passthrough(anomaly_input, image_encoder):
+                    anomaly_img = None  # verified from its header, decoded only if a level needs it
+                else:
+                    anomaly_img = cv2.imread(str(anomaly_input))
+                if anomaly_img is not None and anomaly_img.shape != (1080, 1920, 3):
+                    logging.error(f"Invalid shape {anomaly_img.shape} for {mask.name}")
+                    continue
+                if label_map:
+                    # label map is already the 3 class mask
+                    mask_src = mask
+                else:
+                    # read foreground/background mask
+                    try:
+                        fb_mask = cv2.imread(fb_input)
+                    except Exception as e:
+                        logging.error(f"Failed to read f/b mask: {mask}")
+                        continue
+                    # combine anomaly mask with foreground/background mask
+                    mask_img = combine_masks(mask_img, fb_mask)
+                    mask_src = None
+                # save anomalous image and combined masks at every level
+                done = save_levels(mask.name, cam.name, anomaly_input, levels, encoders, args,
+                                   image=anomaly_img, mask_src=mask_src, mask=mask_img,
+                                   mask_flags=cv2.IMREAD_GRAYSCALE if label_map else cv2.IMREAD_COLOR)
+                if not done:
+                    logging.error(f"Failed to write {mask.name}")
+                else:
+                    cnt += 1
+            except Exception as e:
+                logging.error(f"Failed to read {mask.name} \
+                    or failed to write to {str(mask.name)}")
+                print(e)
+    return cnt
+
+def process_normal_camera(cam, levels, args, encoders, rejected=frozenset()):
+    """Save normal renders of a camera with their masks, resizing odd-sized renders
+    
+    Args:
+        - cam: camera folder with render subfolders
+        - levels: output levels from make_levels
+        - args: parsed arguments
+        - encoders: (image, mask) output encoders
+        - rejected: paths rejected by the header scan
+    
+    Returns:
+        - number of saved samples
+    """
+    label_map = args.mask_layout == "label"
+    cnt = 0
+    # input directories for normal images and masks
+    cam_input_dir = cam / "normal"
+    fb_input_dir = cam / ("label" if label_map else "fb_mask")
+    # label maps saved as webp are 3 channel, read as single channel
+    mask_flags = cv2.IMREAD_GRAYSCALE if label_map else cv2.IMREAD_COLOR
+    # label the fb mask as combine_masks does for the index
+    to_labels = None if label_map else lambda fb_mask: combine_masks(np.zeros_like(fb_mask), fb_mask)
+    # iterate through all normal images in camera folder
+    for f in cam_input_dir.iterdir():
+        done = False
+        if f.suffix in RENDER_SUFFIXES:
+            if rejected.intersection([str(f), str(fb_input_dir / f.name)]):
+                continue
+            #* save normal image and its mask, resized only if not at the level size
+            try:
+                done = save_levels(f.name, cam.name, f, levels, encoders, args,
+                                   mask_src=fb_input_dir / f.name, mask_flags=mask_flags,
+                                   to_labels=to_labels)
+            except Exception as e:
+                logging.error(f"Failed to process {f}")
+            finally:
+                if not done:
+                    logging.error(f"Failed to write {f} to {str(levels[0]['dir'] / cam.name)}")
+                else:
+                    cnt += 1
+        else:
+            logging.info(f"Skipping {f}")
+    return cnt
+
 def main(args):
     print(args.anomaly)
     # find input and output directories, make output directory if needed and log file
@@ -43,6 +398,13 @@ def main(args):
     output_dir.mkdir(parents=True, exist_ok=True)
     log_file = Path(args.log_file)
     logging.basicConfig(filename=str(log_file), level=logging.INFO)
+    # output encoders for images and masks
+    image_encoder = get_encoder(args.image_format, args.image_compression, args.fast_write)
+    mask_encoder = get_encoder(args.mask_format, args.mask_compression, args.fast_write)
+    # one output tree per size, each with its own per-sample statistics index
+    levels = make_levels(output_dir, args.sizes, args.index)
+    # header-only validation results of all cameras
+    report = []
 
     # iterate through all camera folders in input directory
     for cam in tqdm(input_dir.iterdir(), 
@@ -50,99 +412,33 @@ def main(args):
                     total=len(list(input_dir.iterdir()))):
         if cam.is_dir() and cam.name.startswith("Camera"):
             logging.info(f"Processing {cam.name}")
-            cnt = 0
+            # reject corrupt or mis-sized files before any decode
+            rejected = set()
+            if args.prescan or args.scan_only:
+                results, rejected = prescan_camera(cam, args.anomaly, args.mask_layout, args.workers)
+                report.extend(results)
+                for path in sorted(rejected):
+                    logging.error(f"Rejected {path} by header scan")
+                if args.scan_only:
+                    continue
             # images are saved to numbered camera folder with two subfolders: images and masks
-            cam_output_dir = output_dir / cam.name
-            cam_output_dir.mkdir(parents=True, exist_ok=True)
+            for level in levels:
+                (level["dir"] / cam.name / "images").mkdir(parents=True, exist_ok=True)
+                (level["dir"] / cam.name / "masks").mkdir(parents=True, exist_ok=True)
             if args.anomaly:  # combine anomalous masks and save images and masks
-                # anomaly images and anomaly mask input and output folders
-                anomaly_input_dir = cam / "anomaly"
-                anomaly_output_dir = cam_output_dir / "images"
-                anomaly_output_dir.mkdir(parents=True, exist_ok=True)
-                mask_input_dir = cam / "anomaly_mask"
-                mask_output_dir = cam_output_dir / "masks"
-                mask_output_dir.mkdir(parents=True, exist_ok=True)
-                
-                # iterate through saved anomaly masks
-                for mask in mask_input_dir.iterdir():
-                    done = False
-                    if mask.suffix == ".png":
-                        #* Read anomaly mask and verify shape
-                        try:
-                            mask_img = cv2.imread(str(mask))
-                            if mask_img.shape != (1080, 1920, 3):
-                                logging.error(f"Invalid shape {mask_img.shape} for {mask}")
-                                continue
-                        except Exception as e:
-                            logging.error(f"Failed to read {mask}")
-                            continue
-                        #* read anomaly image and foreground/backgrond mask, combine masks
-                        try:
-                            anomaly_img = cv2.imread(str(anomaly_input_dir / mask.name))  # anomalous image
-                            if anomaly_img.shape != (1080, 1920, 3):
-                                logging.error(f"Invalid shape {anomaly_img.shape} for {mask.name}")
-                                continue
-                            else:
-                                # Check number of anomalous pixels, if more than min pixels save
-                                if (np.sum(mask_img == 255) // 3) <= args.min_pixel: 
-                                    logging.info(f"Skipping {mask.name}")
-                                    continue
-                                # read foreground/background mask
-                                try:
-                                    fb_mask = cv2.imread(str(mask).replace("anomaly_mask", "fb_mask"))
-                                except Exception as e:
-                                    logging.error(f"Failed to read f/b mask: {mask}")
-                                    continue
-                                # combine anomaly mask with foreground/background mask
-                                mask_img = combine_masks(mask_img, fb_mask)
-                                # save anomalous image and combined masks
-                                done = cv2.imwrite(str(mask_output_dir / mask.name), mask_img)
-                                done = done and cv2.imwrite(str(anomaly_output_dir / mask.name), anomaly_img)
-                                if not done:
-                                    logging.error(f"Failed to write {mask.name}")
-                                else:
-                                    cnt += 1
-                        except Exception as e:
-                            logging.error(f"Failed to read {mask.name} \
-                                or failed to write to {str(mask.name)}")
-                            print(e)
+                cnt = process_anomaly_camera(cam, levels, args, (image_encoder, mask_encoder), rejected)
             else:  # save normal images with their foreground/background masks
-                # input and output directories for normal images and masks
-                cam_input_dir = cam / "normal"
-                fb_input_dir = cam / "fb_mask"
-                normal_output_dir = cam_output_dir / "images"
-                normal_output_dir.mkdir(parents=True, exist_ok=True)
-                mask_output_dir = cam_output_dir / "masks"
-                mask_output_dir.mkdir(parents=True, exist_ok=True)
-                # iterate through all normal images in camera folder
-                for f in cam_input_dir.iterdir():
-                    done = False
-                    if f.suffix == ".png":
-                        #* read, resize and save normal image to images folder
-                        try:
-                            img = cv2.imread(str(f))
-                            img = cv2.resize(img, (1920, 1080), interpolation=cv2.INTER_AREA)
-                            done = cv2.imwrite(str(normal_output_dir / f.name), img)
-                        except Exception as e:
-                            logging.error(f"Failed to process {f}")
-                        # read, resize and save foreground/background mask to masks folder
-                        try:
-                            fb_mask = cv2.imread(str(fb_input_dir / f.name))
-                            fb_mask = cv2.resize(fb_mask, (1920, 1080), interpolation=cv2.INTER_AREA)
-                            done = done and cv2.imwrite(str(mask_output_dir / f.name), fb_mask)
-                        except Exception as e:
-                            logging.error(f"Failed to process {f}")
-                        finally:
-                            if not done:
-                                logging.error(f"Failed to write {f} to \
-                                    {str(normal_output_dir / f.name)}")
-                            else:
-                                cnt += 1
-                    else:
-                        logging.info(f"Skipping {f}")
-                        
+                cnt = process_normal_camera(cam, levels, args, (image_encoder, mask_encoder), rejected)
             logging.info(f"Processed {cnt} images")
 
+    if report:
+        write_report(report, output_dir / "validation_report.csv")
+        logging.info(f"Scanned {len(report)} files, rejected {sum(not r['valid'] for r in report)}")
+    for level in levels:
+        if level["index"] is not None:
+            save_index(level["index"], level["dir"] / "index.npz")
+            logging.info(f"Saved index of {len(level['index']['path'])} samples to {level['dir']}")
+
 if __name__ == "__main__":
     args = parse_args()
     np.random.seed(args.seed)
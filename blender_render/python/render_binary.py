@@ -19,10 +19,15 @@ sys.path.append(os.path.dirname(bpy.data.filepath))
 sys.path.append(os.getcwd())
 
 from utils import (
-    setup, load_models, setup_cams, get_cam_pos, 
+    setup, load_models, setup_cams, setup_label_output, get_cam_pos, 
     load_anomaly, set_anomaly_position, set_anomaly_scale, 
-    set_anomaly_colour
+    set_anomaly_colour, load_station_sdf, load_placement_pools,
+    CAMERA_DATA_TEST, object_pose, append_metadata,
+    camera_fov, classify_visibility, visibility_tags, VISIBILITY_FLAGS,
+    assets_hash, scene_key, cache_lookup, cache_store, evict_cache
 )
+from encoders import configure_file_slot, encoders_from_config
+from sample_index import mask_stats
 #* ------------------------------------------------
 
 # possible anomaly colours
@@ -77,27 +82,45 @@ def load_ephemeris(ephemeris_path):
         "earth": earth_pose
     }
 
-def render_anomaly_single(output_dir, prefix, anomaly_path, fb_mask_path, anomaly_mask_path, day):
-    '''render an anomalous image
+def render_single(output_dir, prefix, paths, day, render_cache=None):
+    '''render an image and move the file output node outputs to their final names
     
     Args:
         - output_dir: path to camera folder where renders are saved
         - prefix: image file name with scene parameters
-        - anomaly_path: name of anomalous folder where anomalous images are saved
-        - fb_mask_path: name of foreground/background folder where mask is saved
-        - anomaly_mask_path: name of anomaly mask folder where anomaly mask is saved
+        - paths: names of the folders of the file output slots that are written
         - day: current iteration of ephemeris data
+        - render_cache: optional dict with the cache dir and asset hash, renders of an
+            identical scene state are linked from the cache instead of rendered
+    
+    Returns:
+        - list of saved files relative to output_dir
     '''
+    key = None
+    if render_cache is not None:
+        key = scene_key(paths, render_cache["assets"])
+        files = cache_lookup(render_cache["dir"], key, output_dir, prefix, paths, day)
+        if files is not None:
+            # remove leftover outputs of the anomaly preview render
+            for pth in paths:
+                shutil.rmtree(osp.join(output_dir, pth, str(day)), ignore_errors=True)
+            return files
     bpy.ops.render.render(write_still=True)
     # Rename files (bug in file output node)
-    for pth in [anomaly_path, fb_mask_path, anomaly_mask_path]:
+    files = []
+    for pth in paths:
         file_name = os.listdir(osp.join(output_dir, pth, str(day)))[0]
         old_file_name = osp.join(output_dir, pth, str(day), file_name)
-        new_file_name = osp.join(output_dir, pth, f"{day}_{prefix}.png")
+        ext = osp.splitext(file_name)[1]  # depends on the slot's output format
+        new_file_name = osp.join(output_dir, pth, f"{day}_{prefix}{ext}")
         shutil.move(old_file_name, new_file_name)
         shutil.rmtree(osp.join(output_dir, pth, str(day)))
+        files.append(osp.join(pth, f"{day}_{prefix}{ext}"))
+    if key is not None:
+        cache_store(render_cache["dir"], key, output_dir, files, paths)
+    return files
 
-def render_normal_single(output_dir, prefix, normal_path, fb_mask_path, day):
+def render_normal_single(output_dir, prefix, normal_path, fb_mask_path, day, render_cache=None):
     '''render normal image
     
     Args:
@@ -106,18 +129,34 @@ def render_normal_single(output_dir, prefix, normal_path, fb_mask_path, day):
         - normal_path: name of folder where normal images are saved
         - fb_mask_path: name of foreground/background folder where mask is saved
         - day: current iteration of ephemeris data
+        - render_cache: optional render cache from render_single
+    
+    Returns:
+        - list of saved files relative to output_dir
     '''
-    bpy.ops.render.render(write_still=True)
-    # Rename files (bug in file output node)
-    for pth in [normal_path, fb_mask_path]:
-        file_name = os.listdir(osp.join(output_dir, pth, str(day)))[0]
-        old_file_name = osp.join(output_dir, pth, str(day), file_name)
-        new_file_name = osp.join(output_dir, pth, f"{day}_{prefix}.png")
-        shutil.move(old_file_name, new_file_name)
-        shutil.rmtree(osp.join(output_dir, pth, str(day)))
+    return render_single(output_dir, prefix, [normal_path, fb_mask_path], day, render_cache)
+
+
+def anomaly_mask_stats(mask_file, label_map=False):
+    """Count the anomaly pixels of a rendered anomaly mask or label map and find their bounding box
+    
+    Args:
+        - mask_file: path to the rendered mask
+        - label_map: mask_file is a label map instead of an anomaly mask
+    
+    Returns:
+        - int: number of anomaly pixels
+        - [x_min, y_min, x_max, y_max] of the anomaly pixels, or None if there are none
+    """
+    # webp masks are 3 channel, read as single channel
+    image = cv2.imread(mask_file, cv2.IMREAD_GRAYSCALE)
+    # anomaly pixels have label 2 in label maps and are white (255) in anomaly masks
+    anomaly = image == (2 if label_map else 255)
+    counts, bbox = mask_stats(anomaly.astype(np.uint8) * 2)
+    return int(counts[2]), ([int(v) for v in bbox] if counts[2] else None)
 
 
-def check_anomaly_pixels(output_dir, mask_path, day, min_pixels):
+def check_anomaly_pixels(output_dir, mask_path, day, min_pixels, label_map=False):
     """Check if anomaly is of sufficient size.
     
     Args:
@@ -125,9 +164,11 @@ def check_anomaly_pixels(output_dir, mask_path, day, min_pixels):
         - mask_path: name of folder where anomaly mask are saved
         - day: current iteration of ephemeris data
         - min_pixels (int): minimum number of pixels for anomaly to be valid
+        - label_map: mask_path holds single channel label maps instead of anomaly masks
     
     Returns:
         - bool: True if anomaly is valid, False otherwise
+        - int: number of anomaly pixels in the preview render
     """
     # Get nodes from tree
     node_tree = bpy.data.scenes['Scene'].node_tree
@@ -141,10 +182,7 @@ def check_anomaly_pixels(output_dir, mask_path, day, min_pixels):
     bpy.ops.render.render(write_still=True)
     # Read render
     file_name = os.listdir(osp.join(output_dir, mask_path, str(day)))[0]
-    image = cv2.imread(osp.join(output_dir, mask_path, str(day), file_name), cv2.IMREAD_UNCHANGED)
-    
-    # Compute number of white pixels (255)
-    cnt = np.sum(image == 255) // 3
+    cnt, _ = anomaly_mask_stats(osp.join(output_dir, mask_path, str(day), file_name), label_map)
     
     # Reconnect normal and anomalous nodes
     node_tree.links.new(render_layers_node.outputs["Noisy Image"],
@@ -153,10 +191,12 @@ def check_anomaly_pixels(output_dir, mask_path, day, min_pixels):
                         denoise_node.inputs["Normal"])
     node_tree.links.new(render_layers_node.outputs["Denoising Albedo"],
                         denoise_node.inputs["Albedo"])
-    return cnt > min_pixels
+    return cnt > min_pixels, int(cnt)
 
 
-def render_images(cameras, day, combinations, output_dir, anomaly_list, anomalies_dir, minpix, anomalous=False):
+def render_images(cameras, day, combinations, output_dir, anomaly_list, anomalies_dir, minpix, anomalous=False,
+                  encoders=None, station_sdf=None, placement_pools=None, label_slot=None,
+                  visibility=None, skipped=None, render_cache=None):
     '''iterate through cameras around station and render images
     
     Args:
@@ -168,6 +208,17 @@ def render_images(cameras, day, combinations, output_dir, anomaly_list, anomalie
         - anomalies_dir: path to anomaly models
         - anomalous: boolean to make anomalous (True) or normal (False) images
         - minpix: minimum pixels of anomaly 
+        - encoders: optional (image, mask) encoders for the file output slots,
+            None keeps the formats saved in the .blend file
+        - station_sdf: optional station distance field used to pre-filter anomaly positions
+        - placement_pools: optional dict of camera index to pre-validated anomaly positions
+        - label_slot: index of the label map file slot from setup_label_output, None writes
+            the legacy separate fb and anomaly masks
+        - visibility: optional dict of camera name to visibility tags of this day,
+            recorded in the metadata of every render
+        - skipped: optional dict of camera name to the visibility flags for which the
+            camera is not rendered this day
+        - render_cache: optional dict with the cache dir and asset hash, see render_single
     
     '''
     # define objects in scene and setup file output
@@ -182,12 +233,30 @@ def render_images(cameras, day, combinations, output_dir, anomaly_list, anomalie
     fb_mask_path = "fb_mask"
     anomaly_mask_path = "anomaly_mask"
     normal_path = "normal"
+    label_path = "label"
+    label_map = label_slot is not None
+    if encoders is not None:
+        image_encoder, mask_encoder = encoders
+        configure_file_slot(fslots[0], image_encoder)
+        configure_file_slot(fslots[1], mask_encoder)
+        configure_file_slot(fslots[2], mask_encoder)
+        if label_map:
+            configure_file_slot(fslots[label_slot], mask_encoder, color_mode='BW')
 
     # iterate through cameras in scene
     for cam in cameras:
+        # skip eclipsed or sun-blinded views before spending any render time
+        tags = visibility.get(cam.name, []) if visibility is not None else []
+        reasons = skipped.get(cam.name, []) if skipped is not None else []
+        if reasons:
+            print(f"Skipping {cam.name} on day {day}: {', '.join(reasons)}")
+            continue
         bpy.context.scene.camera = cam
         cam_render_path = osp.join(output_dir, cam.name)
         file_output_node.base_path = cam_render_path + "/"
+        # per-camera append-only file with one record per render
+        metadata_path = osp.join(cam_render_path, "metadata.jsonl")
+        camera_pose = object_pose(cam)
         
         # set non-anomaly objects to pass index of 1 for foreground/background mask
         obj_list = ['ISS','moon','earth','sun']
@@ -197,8 +266,15 @@ def render_images(cameras, day, combinations, output_dir, anomaly_list, anomalie
         if anomalous:
             # setup node tree for file saving folders
             fslots[0].path = str(osp.join(anomaly_path, str(day))) + "/"
-            fslots[1].path = str(osp.join(fb_mask_path, str(day))) + "/"
-            fslots[2].path = str(osp.join(anomaly_mask_path, str(day))) + "/"
+            if label_map:
+                fslots[label_slot].path = str(osp.join(label_path, str(day))) + "/"
+                render_paths = [anomaly_path, label_path]
+                pixel_mask_path = label_path
+            else:
+                fslots[1].path = str(osp.join(fb_mask_path, str(day))) + "/"
+                fslots[2].path = str(osp.join(anomaly_mask_path, str(day))) + "/"
+                render_paths = [anomaly_path, fb_mask_path, anomaly_mask_path]
+                pixel_mask_path = anomaly_mask_path
             
             # add anomaly to the scene and set pass index to 2 for anomaly mask
             anomaly = load_anomaly(anomaly_list, anomalies_dir)
@@ -206,6 +282,9 @@ def render_images(cameras, day, combinations, output_dir, anomaly_list, anomalie
             anomaly_obj.pass_index = 2
             anomaly_obj.hide_render = False
             pixel_valid = False
+            pool = None
+            if placement_pools is not None:
+                pool = placement_pools.get(int(cam.name[len("Camera"):]))
             
             # iterate through scene parameter combinations
             for i, comb in enumerate(combinations):
@@ -221,22 +300,24 @@ def render_images(cameras, day, combinations, output_dir, anomaly_list, anomalie
                     orig_colour = None
                     
                     #* depth
-                    anomaly_pos = set_anomaly_position(anomaly_obj, station, cam)
+                    anomaly_pos = set_anomaly_position(anomaly_obj, station, cam, station_sdf=station_sdf, pool=pool)
                     if anomaly_pos is None:
                         break
                     # Check if anomaly has more than min pixels in render
                     bpy.data.scenes["Scene"].cycles.samples = 20
-                    pixel_valid = check_anomaly_pixels(cam_render_path, anomaly_mask_path, day, minpix)
+                    pixel_valid, preview_pixels = check_anomaly_pixels(cam_render_path, pixel_mask_path, day, minpix, label_map)
                     k = 0
                     while not pixel_valid and k < 10:
-                        anomaly_pos = set_anomaly_position(anomaly_obj, station, cam)
-                        pixel_valid = check_anomaly_pixels(cam_render_path, anomaly_mask_path, day, minpix)
+                        anomaly_pos = set_anomaly_position(anomaly_obj, station, cam, station_sdf=station_sdf, pool=pool)
+                        pixel_valid, preview_pixels = check_anomaly_pixels(cam_render_path, pixel_mask_path, day, minpix,
+                                                                           label_map)
                         k += 1
                     # if anomaly cannot meet pixel requirements move on to next combination
                     if not pixel_valid:
                         continue
                 else:  # not first combination,  set anomaly 
-                    pos_valid = set_anomaly_position(anomaly_obj, station, cam, depth, anomaly_pos)
+                    pos_valid = set_anomaly_position(anomaly_obj, station, cam, depth, anomaly_pos,
+                                                     station_sdf=station_sdf)
                     # anomaly size is verified in subsequent processing script
                     if pos_valid is None:
                         continue
@@ -256,7 +337,23 @@ def render_images(cameras, day, combinations, output_dir, anomaly_list, anomalie
                 # file name prefix lists scene parameters for this combination
                 file_prefix = f"{anomaly}_{illum}_{scale}_{depth}_{colour}"
                 bpy.data.scenes["Scene"].cycles.samples = 256
-                render_anomaly_single(cam_render_path, file_prefix, anomaly_path, fb_mask_path, anomaly_mask_path, day)
+                files = render_single(cam_render_path, file_prefix, render_paths, day, render_cache)
+                # the mask is the last written slot
+                pixels, bbox = anomaly_mask_stats(osp.join(cam_render_path, files[-1]), label_map)
+                append_metadata(metadata_path, {
+                    "day": day, "camera": cam.name, "files": files,
+                    "camera_pose": camera_pose, "sun_energy": illum, "visibility": tags,
+                    "anomaly": {
+                        "name": anomaly, "pose": object_pose(anomaly_obj),
+                        "scale": scale, "depth": depth,
+                        "colour": colour, "rgb": COLOURS.get(colour),
+                        # anomaly pixels in the final mask, and in the low-sample preview
+                        # for the depth 0 placement the preview was rendered for
+                        "pixels": pixels,
+                        "preview_pixels": preview_pixels if i == 0 else None,
+                        "bbox": bbox,
+                    },
+                })
             
             # Remove anomaly from scene
             bpy.data.objects[anomaly].select_set(True)
@@ -264,15 +361,27 @@ def render_images(cameras, day, combinations, output_dir, anomaly_list, anomalie
         else:
             # setup node tree
             fslots[0].path = str(osp.join(normal_path, str(day))) + "/"
-            fslots[1].path = str(osp.join(fb_mask_path, str(day))) + "/"
-            fslots[2].path = "/trash/"
+            if label_map:  # anomaly mask slot is unlinked, no trash folder
+                fslots[label_slot].path = str(osp.join(label_path, str(day))) + "/"
+                mask_path = label_path
+            else:
+                fslots[1].path = str(osp.join(fb_mask_path, str(day))) + "/"
+                fslots[2].path = "/trash/"
+                mask_path = fb_mask_path
             #? Illumination variation only
             for i, comb in enumerate(combinations):
                 sun_light.data.energy = comb[0]
                 file_prefix = f"normal_{comb[0]}"
-                render_normal_single(cam_render_path, file_prefix, normal_path, fb_mask_path, day)
-            # delete extra trash folder
-            shutil.rmtree(cam_render_path + "/trash/")
+                files = render_normal_single(cam_render_path, file_prefix, normal_path, mask_path, day,
+                                             render_cache)
+                append_metadata(metadata_path, {
+                    "day": day, "camera": cam.name, "files": files,
+                    "camera_pose": camera_pose, "sun_energy": comb[0], "visibility": tags,
+                    "anomaly": None,
+                })
+            # delete extra trash folder, not created when every render came from the cache
+            if not label_map:
+                shutil.rmtree(cam_render_path + "/trash/", ignore_errors=True)
 
 
 def parse_args():
@@ -312,12 +421,66 @@ def render(args, cfg):
     depths = cfg.get("depths", [])
     scales = cfg.get("scales", [])
     colours = cfg.get("colours", [])
+    # output encoders for images and masks
+    encoders = encoders_from_config(cfg)
+    # single label map from the object index pass, or legacy separate fb and anomaly masks
+    mask_layout = cfg.get("mask_layout", "legacy")
+    if mask_layout not in ("legacy", "label"):
+        raise ValueError(f"Unknown mask_layout {mask_layout}, expected legacy or label")
+    label_slot = setup_label_output() if mask_layout == "label" else None
+    # precomputed station distance field for vectorized anomaly placement checks
+    station_sdf = None
+    if args.anomaly and cfg.get("station_sdf"):
+        objs["ISS"].scale = (1,1,1)
+        objs["ISS"].location = (0, 0, 0)
+        bpy.context.view_layer.update()
+        station_sdf = load_station_sdf(objs["ISS"], **cfg["station_sdf"])
+    # per-camera pools of pre-validated anomaly positions
+    placement_pools = None
+    if args.anomaly and cfg.get("placement_pool"):
+        placement_pools = load_placement_pools(objs["ISS"], [obj for obj in objs if obj.type == 'CAMERA'][0],
+                                               CAMERA_DATA_TEST, cfg["cams"], station_sdf=station_sdf,
+                                               **cfg["placement_pool"])
     # add and setup sun light
     default_sun_strength = 10
     setup_sunlight(default_sun_strength, objs['ISS'])
+    # eclipse and sun/earth/moon visibility of every day and camera from the ephemeris
+    days = list(range(cfg["start_day"], cfg["end_day"]+1, cfg["day_interval"]))
+    skip_visibility = []
+    visibility = None
+    skip_table = None
+    if cfg.get("visibility"):
+        skip_visibility = cfg["visibility"].get("skip", [])
+        unknown = set(skip_visibility) - set(VISIBILITY_FLAGS)
+        if unknown:
+            raise ValueError(f"Unknown visibility flags {sorted(unknown)}, expected {VISIBILITY_FLAGS}")
+        cam_data = [obj for obj in objs if obj.type == 'CAMERA'][0].data
+        scene = bpy.context.scene
+        half_fov = camera_fov(cam_data.lens, cam_data.sensor_width,
+                              (scene.render.resolution_x, scene.render.resolution_y))
+        cam_table = get_cam_pos(cfg["cams"], args.anomaly)
+        # only the rendered days are classified, the first ephemeris row is invalid
+        # tags use the field of view widened to cover the camera pose noise
+        visibility = classify_visibility(ephemeris, cam_table, half_fov,
+                                         cfg["visibility"].get("margin", 0.0), cam_data.clip_end, days)
+        # skipping uses its own margin, the nominal field of view by default
+        if skip_visibility:
+            skip_table = classify_visibility(ephemeris, cam_table, half_fov,
+                                             cfg["visibility"].get("skip_margin", 0.0), cam_data.clip_end, days)
+        for flag in VISIBILITY_FLAGS:
+            print(f"{flag}: {visibility[flag][days].sum()} of {visibility[flag][days].size} views")
+    
+    # content-addressed cache of final renders shared between experiments
+    render_cache = None
+    if cfg.get("render_cache"):
+        asset_files = [bpy.data.filepath]
+        asset_files += [cfg["cad_models_path"] + obj + '.blend' for obj in obj_list]
+        asset_files += [osp.join(cfg["anomalies_path"], a + ".blend") for a in cfg["anomalies"]]
+        render_cache = {"dir": cfg["render_cache"]["dir"], "assets": assets_hash(asset_files)}
+        cache_max_bytes = int(cfg["render_cache"]["max_gb"] * 1024**3)
+        evict_cache(render_cache["dir"], cache_max_bytes)
     
     # Iterate through days in ephemeris and render
-    days = list(range(cfg["start_day"], cfg["end_day"]+1, cfg["day_interval"]))
     for day in tqdm(days):
         # set dimensions and locations of objects
         moon_radius = ephemeris["moon"][day, 0]
@@ -343,6 +506,15 @@ def render(args, cfg):
         
         # setup cameras
         cam_positions = get_cam_pos(cfg["cams"], args.anomaly)
+        day_visibility = None
+        day_skipped = None
+        if visibility is not None:
+            day_visibility = {f"Camera{int(pose[0])}": visibility_tags(visibility, day, i)
+                              for i, pose in enumerate(cam_positions)}
+        if skip_table is not None:
+            day_skipped = {f"Camera{int(pose[0])}": [tag for tag in visibility_tags(skip_table, day, i)
+                                                     if tag in skip_visibility]
+                           for i, pose in enumerate(cam_positions)}
         cam_objs = [obj for obj in objs if obj.type == 'CAMERA']
         for i, cam in enumerate(cam_objs):
             if cam.name == "Camera":
@@ -379,7 +551,12 @@ def render(args, cfg):
         print(opt_combs)
 
         # Render images
-        render_images(cam_objs, day, opt_combs, exp_dir, cfg["anomalies"], cfg["anomalies_path"], cfg["min_pixel"], anomalous=args.anomaly)
+        render_images(cam_objs, day, opt_combs, exp_dir, cfg["anomalies"], cfg["anomalies_path"], cfg["min_pixel"], anomalous=args.anomaly,
+                      encoders=encoders, station_sdf=station_sdf, placement_pools=placement_pools,
+                      label_slot=label_slot, visibility=day_visibility, skipped=day_skipped,
+                      render_cache=render_cache)
+        if render_cache is not None:
+            evict_cache(render_cache["dir"], cache_max_bytes)
 
 if __name__ == "__main__":
     args = parse_args()
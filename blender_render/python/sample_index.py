@@ -0,0 +1,120 @@
+"""Columnar per-sample statistics index written by preprocess.py
+
+The index is a .npz file with one array per column and one row per output
+sample, so samplers can filter and balance a dataset by anomaly size,
+bounding box, foreground fraction, camera or anomaly type without any
+image I/O:
+
+    index = load_index("train/index.npz")
+    large = index["path"][index["n_anomaly"] > 5000]
+"""
+
+from pathlib import Path
+import numpy as np
+
+# column name -> numpy dtype, bbox is (x_min, y_min, x_max, y_max) of the anomaly, -1 if absent
+INDEX_COLUMNS = {
+    "path": str,
+    "camera": str,
+    "day": np.int32,
+    "anomaly": str,
+    "illumination": np.float32,
+    "scale": np.float32,
+    "depth": np.float32,
+    "colour": str,
+    "n_background": np.int64,
+    "n_foreground": np.int64,
+    "n_anomaly": np.int64,
+    "bbox": np.int32,
+    "orig_width": np.int32,
+    "orig_height": np.int32,
+}
+
+
+def parse_sample_name(name):
+    """Parse scene parameters from a render file name
+
+    Anomalous renders are named {day}_{anomaly}_{illum}_{scale}_{depth}_{colour}
+    and normal renders {day}_normal_{illum} by render_binary.py.
+
+    Args:
+        - name: file name of the render
+
+    Returns:
+        - dict with day, anomaly, illumination, scale, depth and colour
+    """
+    parts = Path(name).stem.split("_")
+    if parts[1] == "normal":
+        return {"day": int(parts[0]), "anomaly": "", "illumination": float(parts[2]),
+                "scale": -1.0, "depth": 0.0, "colour": "default"}
+    # anomaly names may contain underscores, scene parameters are the last four fields
+    return {"day": int(parts[0]), "anomaly": "_".join(parts[1:-4]),
+            "illumination": float(parts[-4]), "scale": float(parts[-3]),
+            "depth": float(parts[-2]), "colour": parts[-1]}
+
+
+def mask_stats(mask):
+    """Pixel count per class and anomaly bounding box of a 3 class mask
+
+    Args:
+        - mask: mask with values {0,1,2} from combine_masks, single or 3 channel
+
+    Returns:
+        - counts: number of background, foreground and anomaly pixels
+        - bbox: (x_min, y_min, x_max, y_max) of the anomaly, all -1 if there is none
+    """
+    if mask.ndim == 3:
+        mask = mask[..., 0]
+    counts = np.bincount(mask.ravel(), minlength=3)[:3]
+    ys, xs = np.nonzero(mask == 2)
+    if len(xs) == 0:
+        bbox = (-1, -1, -1, -1)
+    else:
+        bbox = (xs.min(), ys.min(), xs.max(), ys.max())
+    return counts, bbox
+
+
+def new_index():
+    """Empty index with a list per column"""
+    return {col: [] for col in INDEX_COLUMNS}
+
+
+def add_index_row(index, path, camera, mask, orig_size):
+    """Append one output sample to the index
+
+    Args:
+        - index: index from new_index
+        - path: path of the output image relative to the output directory
+        - camera: camera folder name
+        - mask: saved 3 class mask
+        - orig_size: (width, height) of the rendered image
+    """
+    counts, bbox = mask_stats(mask)
+    row = parse_sample_name(path)
+    row.update({
+        "path": str(path), "camera": camera,
+        "n_background": counts[0], "n_foreground": counts[1], "n_anomaly": counts[2],
+        "bbox": bbox, "orig_width": orig_size[0], "orig_height": orig_size[1],
+    })
+    for col in INDEX_COLUMNS:
+        index[col].append(row[col])
+
+
+def load_index(path):
+    """Load an index as a dict of column arrays"""
+    with np.load(path, allow_pickle=False) as data:
+        return {col: data[col] for col in data.files}
+
+
+def save_index(index, path):
+    """Save an index, merging with an existing index at path
+
+    Rows of the existing index whose output path was written again are replaced.
+    """
+    columns = {col: np.asarray(index[col], dtype=dtype) for col, dtype in INDEX_COLUMNS.items()}
+    columns["bbox"] = columns["bbox"].reshape(-1, 4)
+    if Path(path).exists():
+        old = load_index(path)
+        keep = ~np.isin(old["path"], columns["path"])
+        columns = {col: np.concatenate([old[col][keep], columns[col]]) for col in INDEX_COLUMNS}
+    np.savez(path, **columns)
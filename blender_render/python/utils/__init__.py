@@ -1,12 +1,22 @@
-from .setup import (setup, load_models, setup_cams)
-from .camera import get_cam_pos
+from .setup import (setup, load_models, setup_cams, setup_label_output)
+from .camera import get_cam_pos, CAMERA_DATA_TRAIN, CAMERA_DATA_TEST
 from .anomaly import (
     load_anomaly, set_anomaly_position, set_anomaly_scale,
     set_anomaly_colour
 )
+from .station_sdf import load_station_sdf, classify_positions
+from .placement_pool import load_placement_pools
+from .metadata import object_pose, append_metadata, load_metadata
+from .visibility import camera_fov, classify_visibility, visibility_tags, VISIBILITY_FLAGS
+from .render_cache import assets_hash, scene_key, cache_lookup, cache_store, evict_cache
 
 __all__ = [
-    'setup', 'load_models', 'setup_cams', 'get_cam_pos',
+    'setup', 'load_models', 'setup_cams', 'setup_label_output', 'get_cam_pos',
+    'CAMERA_DATA_TRAIN', 'CAMERA_DATA_TEST',
     'load_anomaly', 'set_anomaly_position', 'set_anomaly_scale',
-    'set_anomaly_colour'
+    'set_anomaly_colour', 'load_station_sdf', 'classify_positions',
+    'load_placement_pools', 'object_pose',
+    'append_metadata', 'load_metadata', 'camera_fov', 'classify_visibility',
+    'visibility_tags', 'VISIBILITY_FLAGS', 'assets_hash', 'scene_key',
+    'cache_lookup', 'cache_store', 'evict_cache'
 ]
\ No newline at end of file
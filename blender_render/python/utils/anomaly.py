@@ -8,6 +8,7 @@ from mathutils import Vector
 from mathutils.bvhtree import BVHTree
 
 from .camera import get_camera_forward
+from .station_sdf import CLEAR, NEAR_SURFACE, bounding_radius, classify_positions
 
 
 def load_anomaly(anomaly_list, anomalies_dir):
@@ -25,40 +26,23 @@ def load_anomaly(anomaly_list, anomalies_dir):
                         filename=anomaly_obj)
     return anomaly_obj
 
-def loc_check(station, anomaly, cam):
+def loc_check(station, anomaly, cam, skip_station=False):
     """Check if anomaly is in a valid position (camera can see it and it doesn't overlap with station)
     Args:
         - station: station model object
         - anomaly: anomaly model object
         - cam: camera object
+        - skip_station: skip the overlap and inside station checks, for positions
+            already cleared by the station distance field
     Returns: 
         -valid: booloan, False if location is good and True if location is bad
     """
-    # 1. check if the anomaly goes through the station mesh
-    # Get their world matrix
-    mat1 = station.matrix_world
-    mat2 = anomaly.matrix_world
-    # Get the geometry in world coordinates
-    vert1 = [mat1 @ v.co for v in station.data.vertices] 
-    poly1 = [p.vertices for p in station.data.polygons]
-    vert2 = [mat2 @ v.co for v in anomaly.data.vertices] 
-    poly2 = [p.vertices for p in anomaly.data.polygons]
-    # Create the BVH trees
-    bvh1 = BVHTree.FromPolygons( vert1, poly1 )
-    bvh2 = BVHTree.FromPolygons( vert2, poly2 )
-    
-    overlap = bvh1.overlap( bvh2 )  #* boolean for overlap
-    
-    # 2. check if anomaly is completely inside ISS mesh
     anomaly_location = anomaly.location
-    x,y,z = anomaly_location
-    dest_point = Vector((x, y, z+100)) # destination will be point far from the anomaly and station
-    # create vector from station, through anomaly, to far away destination point
     origin =  station.matrix_local.inverted()@anomaly_location
-    destination = station.matrix_local.inverted()@dest_point
-    direction = (destination - origin).normalized() 
-    # shooting ray from origin along destination point vector, if it hits then the object is sitting inside the station
-    iss_hit, _, _, _ = station.ray_cast(origin, direction)  #* boolean for anomaly inside ISS 
+    if skip_station:
+        overlap, iss_hit = False, False
+    else:
+        overlap, iss_hit = station_check(station, anomaly)
     
     # 3. check if anomaly is occluded from the camera by the station
     cam_point = cam.location
@@ -85,6 +69,44 @@ def loc_check(station, anomaly, cam):
     return valid
 
 
+def station_check(station, anomaly):
+    """Exact check of the anomaly against the station mesh
+    Args:
+        - station: station model object
+        - anomaly: anomaly model object
+    Returns:
+        - overlap: True if the anomaly mesh intersects the station mesh
+        - iss_hit: True if the anomaly is inside the station
+    """
+    # 1. check if the anomaly goes through the station mesh
+    # Get their world matrix
+    mat1 = station.matrix_world
+    mat2 = anomaly.matrix_world
+    # Get the geometry in world coordinates
+    vert1 = [mat1 @ v.co for v in station.data.vertices] 
+    poly1 = [p.vertices for p in station.data.polygons]
+    vert2 = [mat2 @ v.co for v in anomaly.data.vertices] 
+    poly2 = [p.vertices for p in anomaly.data.polygons]
+    # Create the BVH trees
+    bvh1 = BVHTree.FromPolygons( vert1, poly1 )
+    bvh2 = BVHTree.FromPolygons( vert2, poly2 )
+    
+    overlap = bvh1.overlap( bvh2 )  #* boolean for overlap
+    
+    # 2. check if anomaly is completely inside ISS mesh
+    anomaly_location = anomaly.location
+    x,y,z = anomaly_location
+    dest_point = Vector((x, y, z+100)) # destination will be point far from the anomaly and station
+    # create vector from station, through anomaly, to far away destination point
+    origin =  station.matrix_local.inverted()@anomaly_location
+    destination = station.matrix_local.inverted()@dest_point
+    direction = (destination - origin).normalized() 
+    # shooting ray from origin along destination point vector, if it hits then the object is sitting inside the station
+    iss_hit, _, _, _ = station.ray_cast(origin, direction)  #* boolean for anomaly inside ISS 
+    
+    return overlap, iss_hit
+
+
 def anomaly_box(cam_pos, cam_euler):
     """Calculates bounding box of possible anomaly locations
     Args:
@@ -107,7 +129,7 @@ def anomaly_box(cam_pos, cam_euler):
     return bbox, forward
 
 
-def set_anomaly_position(anomaly, station, cam, d=1, prev_loc=None):
+def set_anomaly_position(anomaly, station, cam, d=1, prev_loc=None, station_sdf=None, pool=None):
     ''' place anomaly inside camera frustrum
     Args:
         - anomaly: anomaly model object
@@ -115,6 +137,10 @@ def set_anomaly_position(anomaly, station, cam, d=1, prev_loc=None):
         - cam: active camera
         - d: depth of anomaly from scene parameter combination
         - prev_loc: previous location of anomaly from past parameter combination
+        - station_sdf: optional station distance field, candidates are classified in one
+            call and only those near the station surface get the exact BVH check
+        - pool: optional placement pool of this camera from load_placement_pools,
+            candidates are drawn from it instead of the anomaly bounding box
     Returns:
         - loc: new anomaly position or None if anomaly could not be placed in a valid location'''
     # if there is a previous location inputted (this isn't the first combination) only move anomaly along z axis relative to camera
@@ -122,26 +148,40 @@ def set_anomaly_position(anomaly, station, cam, d=1, prev_loc=None):
     if not vary_z_only:  # randomly rotate anomaly
         anomaly.rotation_euler = np.random.uniform(low=0, high=2*np.pi, size=(3,))
     bbox, forward = anomaly_box(cam.location, cam.rotation_euler)
-    rng = np.random.default_rng()
+    # drawn from the seeded global state so reruns with the same seed place anomalies identically
+    rng = np.random.default_rng(np.random.randint(2**32))
+    max_tries = 100
+    
+    stages = []
+    if vary_z_only:  # move anomaly closer or further from camera
+        stages.append((np.array([prev_loc + d * forward]), None))
+    else:
+        if pool is not None and len(pool["positions"]) > 0:
+            # draw pre-validated positions, only the station check depends on the anomaly size
+            draw = rng.choice(len(pool["positions"]), size=min(max_tries, len(pool["positions"])), replace=False)
+            stages.append((pool["positions"][draw],
+                           np.where(pool["clearance"][draw] > bounding_radius(anomaly), CLEAR, NEAR_SURFACE)))
+        # set location of anomaly by uniform sampling in bounding box, also the fallback
+        # when no pool position is valid for the camera pose after the random noise
+        stages.append((rng.uniform([bbox[0], bbox[2], bbox[4]],
+                                   [bbox[1], bbox[3], bbox[5]], size=(max_tries, 3)), None))
     
-    # place anomaly inside bounding box while checking validity of anomaly location
-    valid = False
-    i = 0
-    while not valid and i < 100:
-        if vary_z_only:  # move anomaly closer or further from camera
-            loc = prev_loc + d * forward
-        else:
-            # set location of anomaly by uniform sampling in bounding box
-            loc = rng.uniform([bbox[0], bbox[2], bbox[4]], 
-                            [bbox[1], bbox[3], bbox[5]])
-        anomaly.location = loc
-        # update scene and check anomaly position 
-        bpy.context.view_layer.update()
-        valid = loc_check(station, anomaly, cam)
-        i += 1
-    if not valid:
-        return None
-    return loc
+    for candidates, labels in stages:
+        if labels is None:
+            if station_sdf is not None:
+                labels = classify_positions(station_sdf, candidates, bounding_radius(anomaly))
+            else:
+                labels = np.full(len(candidates), NEAR_SURFACE)
+        # place anomaly inside bounding box while checking validity of anomaly location
+        for loc, label in zip(candidates, labels):
+            if label not in (CLEAR, NEAR_SURFACE):  # inside the station
+                continue
+            anomaly.location = loc
+            # update scene and check anomaly position 
+            bpy.context.view_layer.update()
+            if loc_check(station, anomaly, cam, skip_station=label == CLEAR):
+                return loc
+    return None
         
 def set_anomaly_scale(anomaly, scale):
     """ Sets anomaly scale to specified value """
@@ -0,0 +1,28 @@
+import json
+
+
+def object_pose(obj):
+    """ location, euler rotation and scale of an object as lists """
+    return {
+        "location": list(obj.location),
+        "rotation_euler": list(obj.rotation_euler),
+        "scale": list(obj.scale),
+    }
+
+
+def _to_json(o):
+    if hasattr(o, "tolist"):  # numpy values
+        return o.tolist()
+    return list(o)  # mathutils vectors and colours
+
+
+def append_metadata(path, record):
+    """ append a render record to a per-camera json lines file """
+    with open(path, "a") as f:
+        f.write(json.dumps(record, default=_to_json) + "\n")
+
+
+def load_metadata(path):
+    """ load all render records of a per-camera json lines file """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,113 @@
+import bpy
+import bpy_extras
+import hashlib
+from pathlib import Path
+import numpy as np
+from mathutils import Vector
+
+from .anomaly import anomaly_box
+from .station_sdf import mesh_hash, sample_sdf, save_npz_atomic
+
+
+def build_placement_pool(station, cam, cam_pose, station_sdf=None, n_samples=5000, frustum_margin=0.1):
+    """ sample anomaly positions that are valid for the nominal pose of one camera
+    Positions must be inside the frustum shrunk by frustum_margin on every side,
+    outside the station, and not occluded by the station, so most of them stay
+    valid under the random pose noise added to the cameras in render_binary.py
+    Args:
+        - station: station model object
+        - cam: camera object, its pose is set to cam_pose
+        - cam_pose: camera table row (camera index, x,y,z, roll, pitch, yaw)
+        - station_sdf: optional station distance field used for the station clearance
+        - n_samples: number of positions sampled in the anomaly box
+        - frustum_margin: margin in normalized image coordinates
+    Returns:
+        - pool: dict with positions (K, 3) and their station clearance (K,),
+            clearance is -inf when no distance field is given
+    """
+    cam.location = cam_pose[1:4]
+    cam.rotation_euler = cam_pose[4:7]
+    bpy.context.view_layer.update()
+    bbox, _ = anomaly_box(cam.location, cam.rotation_euler)
+    rng = np.random.default_rng(int(cam_pose[0]))
+    points = rng.uniform([bbox[0], bbox[2], bbox[4]],
+                         [bbox[1], bbox[3], bbox[5]], size=(n_samples, 3))
+
+    #* station clearance, drop positions inside or touching the station
+    if station_sdf is not None:
+        d, tol = sample_sdf(station_sdf, points)
+        clearance = d - tol
+        keep = clearance > 0
+        points, clearance = points[keep], clearance[keep]
+    else:
+        clearance = np.full(len(points), -np.inf)
+
+    #* frustum with margin and occlusion by the station
+    to_local = station.matrix_local.inverted()
+    cam_local = to_local @ cam.location
+    keep = np.zeros(len(points), dtype=bool)
+    for i, p in enumerate(points):
+        p = Vector(p)
+        p2D = bpy_extras.object_utils.world_to_camera_view(bpy.context.scene, cam, p)
+        if not (frustum_margin < p2D.x < 1 - frustum_margin
+                and frustum_margin < p2D.y < 1 - frustum_margin and p2D.z > 0):
+            continue
+        origin = to_local @ p
+        cam_hit, _, _, _ = station.ray_cast(origin, (cam_local - origin).normalized())
+        keep[i] = not cam_hit
+    return {"positions": points[keep], "clearance": clearance[keep]}
+
+
+def load_placement_pools(station, cam, cam_table, cam_indices, cache_dir, station_sdf=None,
+                         n_samples=5000, frustum_margin=0.1):
+    """ load per-camera placement pools from the cache, building them if the
+    station model, camera table or pool settings changed
+    Args:
+        - station: station model object
+        - cam: camera object used to build the pools, its pose is overwritten
+        - cam_table: camera table (CAMERA_DATA_TRAIN or CAMERA_DATA_TEST)
+        - cam_indices: camera indices to build pools for
+        - cache_dir: folder where pools are saved
+        - station_sdf: optional station distance field used for the station clearance
+        - n_samples: number of positions sampled per camera
+        - frustum_margin: margin in normalized image coordinates
+    Returns:
+        - pools: dict of camera index to pool from build_placement_pool
+    """
+    h = hashlib.sha1()
+    h.update(mesh_hash(station).encode())
+    h.update(np.ascontiguousarray(cam_table, dtype=np.float64).tobytes())
+    h.update(f"{cam.data.lens}_{cam.data.sensor_width}_{n_samples}_{frustum_margin}_{station_sdf is not None}".encode())
+    if station_sdf is not None:
+        h.update(f"{station_sdf['voxel_size']}_{station_sdf['max_distance']}".encode())
+    cache_path = Path(cache_dir) / f"placement_pool_{h.hexdigest()}.npz"
+
+    pools = {}
+    if cache_path.exists():
+        with np.load(cache_path) as data:
+            for idx in cam_indices:
+                if f"positions_{idx}" in data.files:
+                    pools[idx] = {"positions": data[f"positions_{idx}"],
+                                  "clearance": data[f"clearance_{idx}"]}
+    missing = [idx for idx in cam_indices if idx not in pools]
+    if not missing:
+        return pools
+
+    print(f"Building anomaly placement pools for cameras {missing}: {cache_path}")
+    loc, rot = cam.location.copy(), cam.rotation_euler.copy()
+    for idx in missing:
+        pools[idx] = build_placement_pool(station, cam, cam_table[idx], station_sdf,
+                                          n_samples, frustum_margin)
+    cam.location, cam.rotation_euler = loc, rot
+    bpy.context.view_layer.update()
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # keep the pools of other cameras saved by runs over other camera ranges
+    arrays = {}
+    if cache_path.exists():
+        with np.load(cache_path) as data:
+            arrays = {k: data[k] for k in data.files}
+    for idx, pool in pools.items():
+        arrays[f"positions_{idx}"] = pool["positions"]
+        arrays[f"clearance_{idx}"] = pool["clearance"]
+    save_npz_atomic(cache_path, arrays)
+    return pools
@@ -0,0 +1,181 @@
+import bpy
+import hashlib
+import os
+import os.path as osp
+from pathlib import Path
+import shutil
+
+# file hashes memoized by (path, size, mtime)
+_FILE_HASHES = {}
+
+
+def file_hash(path):
+    """ sha1 of a file's contents, memoized until the file changes """
+    st = os.stat(path)
+    memo = (str(path), st.st_size, st.st_mtime_ns)
+    if memo not in _FILE_HASHES:
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _FILE_HASHES[memo] = h.hexdigest()
+    return _FILE_HASHES[memo]
+
+
+def assets_hash(paths):
+    """ combined hash of the .blend and asset files a render depends on, missing files are skipped """
+    h = hashlib.sha1()
+    for path in sorted(set(str(p) for p in paths if p and osp.isfile(p))):
+        h.update(f"{osp.basename(path)}:{file_hash(path)}".encode())
+    return h.hexdigest()
+
+
+def _format_state(fmt):
+    return (fmt.file_format, fmt.color_mode, fmt.color_depth, fmt.compression)
+
+
+def scene_key(paths, asset_hash):
+    """ hash of the complete scene state that determines a render
+    Covers the active camera, the transform of every rendered object, light,
+    camera and principled base colour settings, render and sample settings,
+    the compositor links and file output formats, and the asset file hash
+    Args:
+        - paths: names of the folders of the file output slots that are written
+        - asset_hash: hash of the asset files from assets_hash
+    Returns:
+        - hex digest used as the cache key
+    """
+    scene = bpy.context.scene
+    bpy.context.view_layer.update()  # resolve constraints such as the sun light tracking
+    h = hashlib.sha1(asset_hash.encode())
+    render = scene.render
+    h.update(repr((scene.camera.name, render.engine, render.resolution_x, render.resolution_y,
+                   render.resolution_percentage, render.dither_intensity, scene.cycles.samples,
+                   scene.cycles.seed, list(paths))).encode())
+    #* objects, lights, cameras and materials
+    for obj in sorted(scene.objects, key=lambda o: o.name):
+        if obj.hide_render:
+            continue
+        state = [obj.name, obj.type, obj.pass_index, [list(row) for row in obj.matrix_world]]
+        if obj.type == 'CAMERA':
+            state += [obj.data.lens, obj.data.sensor_width, obj.data.clip_start, obj.data.clip_end]
+        elif obj.type == 'LIGHT':
+            state += [obj.data.type, obj.data.energy, list(obj.data.color),
+                      getattr(obj.data, "angle", None), getattr(obj.data, "spot_size", None)]
+        elif obj.type == 'MESH':
+            for mat in obj.data.materials:
+                if mat is None or not mat.use_nodes:
+                    continue
+                for node in mat.node_tree.nodes:
+                    if node.type == 'BSDF_PRINCIPLED':
+                        state += [mat.name, node.name, list(node.inputs[0].default_value)]
+        h.update(repr(state).encode())
+    #* compositor outputs
+    node_tree = scene.node_tree
+    # sorted, removing and re-adding links (check_anomaly_pixels) reorders the list
+    links = sorted((link.from_node.name, link.from_socket.identifier,
+                    link.to_node.name, link.to_socket.identifier) for link in node_tree.links)
+    h.update(repr(links).encode())
+    file_output_node = node_tree.nodes["File Output"]
+    h.update(repr(_format_state(file_output_node.format)).encode())
+    for slot in file_output_node.file_slots:
+        h.update(repr((slot.use_node_format, _format_state(slot.format))).encode())
+    return h.hexdigest()
+
+
+def _link_or_copy(src, dst):
+    """ hardlink src to dst, copying when linking is not possible """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _entry_dir(cache_dir, key):
+    return Path(cache_dir) / key[:2] / key
+
+
+def cache_lookup(cache_dir, key, output_dir, prefix, paths, day):
+    """ serve a render from the cache
+    Args:
+        - cache_dir: shared render cache folder
+        - key: scene key from scene_key
+        - output_dir: path to camera folder where renders are saved
+        - prefix: image file name with scene parameters
+        - paths: names of the folders of the file output slots that are written
+        - day: current iteration of ephemeris data
+    Returns:
+        - list of saved files relative to output_dir, or None on a cache miss
+    """
+    entry = _entry_dir(cache_dir, key)
+    if not entry.is_dir():
+        return None
+    cached = {osp.splitext(f)[0]: f for f in os.listdir(entry)}
+    if any(pth not in cached for pth in paths):
+        return None
+    files = []
+    for pth in paths:
+        ext = osp.splitext(cached[pth])[1]
+        dst = osp.join(output_dir, pth, f"{day}_{prefix}{ext}")
+        os.makedirs(osp.dirname(dst), exist_ok=True)
+        if osp.exists(dst):
+            os.remove(dst)
+        _link_or_copy(entry / cached[pth], dst)
+        files.append(osp.join(pth, f"{day}_{prefix}{ext}"))
+    os.utime(entry)  # most recently used
+    return files
+
+
+def cache_store(cache_dir, key, output_dir, files, paths):
+    """ add the files of a fresh render to the cache
+    Files are linked into a temporary folder that is renamed into place, so
+    processes sharing the cache never see partial entries
+    Args:
+        - cache_dir: shared render cache folder
+        - key: scene key from scene_key
+        - output_dir: path to camera folder where renders are saved
+        - files: saved files relative to output_dir from render_single
+        - paths: names of the folders of the file output slots that were written
+    """
+    entry = _entry_dir(cache_dir, key)
+    if entry.is_dir():
+        return
+    tmp = entry.parent / f".{key}.{os.getpid()}.tmp"
+    tmp.mkdir(parents=True, exist_ok=True)
+    for pth, f in zip(paths, files):
+        _link_or_copy(osp.join(output_dir, f), tmp / f"{pth}{osp.splitext(f)[1]}")
+    try:
+        os.rename(tmp, entry)
+    except OSError:  # stored by another process in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def evict_cache(cache_dir, max_bytes):
+    """ delete least recently used cache entries until the cache fits in max_bytes
+    Args:
+        - cache_dir: shared render cache folder
+        - max_bytes: maximum total size of the cached files
+    Returns:
+        - number of evicted entries
+    """
+    entries = []
+    total = 0
+    if not osp.isdir(cache_dir):
+        return 0
+    for shard in os.scandir(cache_dir):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            if entry.name.startswith(".") or not entry.is_dir():
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+            total += size
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        evicted += 1
+    return evicted
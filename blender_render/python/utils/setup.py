@@ -62,3 +62,48 @@ def setup_cams(n):
         bpy.data.objects["Spot"].data.energy = 500
         bpy.data.objects["Spot"].data.spot_size = 80
         bpy.data.objects["Spot"].name = "Spot_"+str(cam_num+1)
+
+def setup_label_output(label_path="label"):
+    """ add a File Output slot writing the object index pass as a single channel
+    8-bit label map (0 background, 1 station and celestial bodies, 2 anomaly)
+    and unlink the separate fb and anomaly mask slots so they are not written
+    Args:
+        - label_path: name of the label slot
+    Returns:
+        - index of the label file slot
+    """
+    scene = bpy.context.scene
+    node_tree = scene.node_tree
+    file_output_node = node_tree.nodes["File Output"]
+    if label_path in [slot.path for slot in file_output_node.file_slots]:
+        return [slot.path for slot in file_output_node.file_slots].index(label_path)
+    bpy.context.view_layer.use_pass_object_index = True
+    # dithering adds noise before 8-bit quantization and would change label values,
+    # the setting is scene-wide so the RGB image output is also written without dithering
+    scene.render.dither_intensity = 0
+    
+    # unlink fb and anomaly mask slots, unlinked slots are not saved
+    for socket in file_output_node.inputs[1:3]:
+        for link in list(socket.links):
+            node_tree.links.remove(link)
+    
+    # pass index / 255 is written as the pass index in an 8-bit image
+    scale_node = node_tree.nodes.new("CompositorNodeMath")
+    scale_node.operation = 'DIVIDE'
+    scale_node.inputs[1].default_value = 255
+    node_tree.links.new(node_tree.nodes["Render Layers"].outputs["IndexOB"], scale_node.inputs[0])
+    file_output_node.file_slots.new(label_path)
+    node_tree.links.new(scale_node.outputs[0], file_output_node.inputs[-1])
+    
+    slot = file_output_node.file_slots[-1]
+    slot.use_node_format = False
+    slot.format.file_format = 'PNG'
+    slot.format.color_mode = 'BW'
+    slot.format.color_depth = '8'
+    # write linear values, the view transform would remap label values
+    slot.format.color_management = 'OVERRIDE'
+    slot.format.view_settings.view_transform = 'Raw'
+    slot.format.view_settings.look = 'None'
+    slot.format.view_settings.exposure = 0
+    slot.format.view_settings.gamma = 1
+    return len(file_output_node.file_slots) - 1
@@ -0,0 +1,171 @@
+import hashlib
+import os
+from pathlib import Path
+import numpy as np
+from mathutils.bvhtree import BVHTree
+
+#* placement classes returned by classify_positions
+CLEAR = 0           # bounding sphere is clear of the station
+INSIDE = 1          # centre is inside the station
+NEAR_SURFACE = 2    # bounding sphere may reach the station, needs the exact BVH check
+
+
+def mesh_arrays(obj):
+    """ world space vertices and triangles of a mesh object
+    Args:
+        - obj: blender mesh object
+    Returns:
+        - verts: (N, 3) float array of world coordinates
+        - tris: (M, 3) int array of vertex indices
+    """
+    mesh = obj.data
+    verts = np.empty(len(mesh.vertices) * 3, dtype=np.float64)
+    mesh.vertices.foreach_get("co", verts)
+    mat = np.array(obj.matrix_world)
+    verts = verts.reshape(-1, 3) @ mat[:3, :3].T + mat[:3, 3]
+    mesh.calc_loop_triangles()
+    tris = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int64)
+    mesh.loop_triangles.foreach_get("vertices", tris)
+    return verts, tris.reshape(-1, 3)
+
+
+def mesh_hash(obj):
+    """ hash of the world space geometry of a mesh object, used as a cache key """
+    verts, tris = mesh_arrays(obj)
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(verts, dtype=np.float32).tobytes())
+    h.update(np.ascontiguousarray(tris, dtype=np.int32).tobytes())
+    return h.hexdigest()
+
+
+def _exterior(free):
+    """ flood fill free voxels connected to the grid border """
+    ext = np.zeros_like(free)
+    for axis in range(3):
+        for end in (0, -1):
+            sl = [slice(None)] * 3
+            sl[axis] = end
+            ext[tuple(sl)] = free[tuple(sl)]
+    while True:
+        grown = ext.copy()
+        grown[1:] |= ext[:-1]
+        grown[:-1] |= ext[1:]
+        grown[:, 1:] |= ext[:, :-1]
+        grown[:, :-1] |= ext[:, 1:]
+        grown[:, :, 1:] |= ext[:, :, :-1]
+        grown[:, :, :-1] |= ext[:, :, 1:]
+        grown &= free
+        if np.array_equal(grown, ext):
+            return ext
+        ext = grown
+
+
+def save_npz_atomic(path, arrays):
+    """ save arrays to a shared cache file, written to a temporary file and renamed
+    so readers never see a partial file """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.stem}.{os.getpid()}.npz")
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def build_station_sdf(station, voxel_size=0.5, max_distance=4.0):
+    """ sample a signed distance field of the station mesh on a voxel grid
+    Args:
+        - station: station model object
+        - voxel_size: grid spacing in blender units
+        - max_distance: distances are clamped to this value
+    Returns:
+        - sdf: dict with the distance grid (positive outside), grid origin, voxel size and max distance
+    """
+    verts, tris = mesh_arrays(station)
+    bvh = BVHTree.FromPolygons(verts.tolist(), tris.tolist())
+    origin = verts.min(axis=0) - max_distance
+    shape = np.ceil((verts.max(axis=0) + max_distance - origin) / voxel_size).astype(int) + 1
+    axes = [origin[i] + voxel_size * np.arange(shape[i]) for i in range(3)]
+    points = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 3)
+
+    #* unsigned distance to the nearest surface, clamped at max_distance
+    dist = np.full(len(points), max_distance, dtype=np.float32)
+    for i, p in enumerate(points.tolist()):
+        loc, _, _, d = bvh.find_nearest(p, max_distance)
+        if loc is not None:
+            dist[i] = d
+    dist = dist.reshape(shape)
+
+    #* voxels not reachable from outside without crossing the surface are inside
+    surface = dist <= np.sqrt(3) / 2 * voxel_size
+    inside = ~(_exterior(~surface) | surface)
+    dist[inside] *= -1
+    return {
+        "sdf": dist,
+        "origin": origin,
+        "voxel_size": np.float64(voxel_size),
+        "max_distance": np.float64(max_distance),
+    }
+
+
+def load_station_sdf(station, cache_dir, voxel_size=0.5, max_distance=4.0):
+    """ load the station distance field from the cache, building it if the mesh changed
+    Args:
+        - station: station model object
+        - cache_dir: folder where distance fields are saved, keyed by mesh hash
+        - voxel_size: grid spacing in blender units
+        - max_distance: distances are clamped to this value
+    Returns:
+        - sdf: distance field from build_station_sdf
+    """
+    key = f"{mesh_hash(station)}_{voxel_size}_{max_distance}"
+    cache_path = Path(cache_dir) / f"station_sdf_{hashlib.sha1(key.encode()).hexdigest()}.npz"
+    if cache_path.exists():
+        with np.load(cache_path) as data:
+            return {k: data[k] for k in data.files}
+    print(f"Building station distance field: {cache_path}")
+    sdf = build_station_sdf(station, voxel_size, max_distance)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    save_npz_atomic(cache_path, sdf)
+    return sdf
+
+
+def bounding_radius(obj):
+    """ radius of a sphere around the object origin enclosing the object at any rotation """
+    corners = np.array([c[:] for c in obj.bound_box]) * np.array(obj.scale)
+    return float(np.linalg.norm(corners, axis=1).max())
+
+
+def sample_sdf(sdf, points):
+    """ signed distance of points to the station surface from the nearest voxel
+    Args:
+        - sdf: distance field from load_station_sdf
+        - points: (N, 3) array of positions in world coordinates
+    Returns:
+        - d: (N,) signed distances, positive outside, points outside the grid get max_distance
+        - tol: lookup error bound, half a voxel diagonal
+    """
+    grid = sdf["sdf"]
+    points = np.atleast_2d(points)
+    idx = np.rint((points - sdf["origin"]) / sdf["voxel_size"]).astype(int)
+    in_grid = np.all((idx >= 0) & (idx < grid.shape), axis=1)
+    d = np.full(len(points), float(sdf["max_distance"]))
+    d[in_grid] = grid[tuple(idx[in_grid].T)]
+    return d, np.sqrt(3) / 2 * float(sdf["voxel_size"])
+
+
+def classify_positions(sdf, points, radius):
+    """ classify candidate anomaly positions against the station distance field
+    Only clear and inside positions are decided from the grid. A bounding sphere
+    reaching the station surface is not an overlap of the mesh itself, so those
+    positions get the exact BVH check. Distances are clamped at max_distance and
+    are a lower bound there, so a clamped value is only clear if it exceeds the radius.
+    Args:
+        - sdf: distance field from load_station_sdf
+        - points: (N, 3) array of anomaly positions in world coordinates
+        - radius: bounding radius of the anomaly
+    Returns:
+        - (N,) int array of CLEAR, INSIDE or NEAR_SURFACE
+    """
+    d, tol = sample_sdf(sdf, points)
+    labels = np.full(len(d), NEAR_SURFACE, dtype=np.int8)
+    labels[d > radius + tol] = CLEAR
+    labels[d < -tol] = INSIDE
+    return labels
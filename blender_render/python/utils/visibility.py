@@ -0,0 +1,103 @@
+import numpy as np
+
+from .camera import rotation_matrix_from_euler
+
+#* visibility flags returned by classify_visibility
+VISIBILITY_FLAGS = ("eclipse", "sun_in_view", "earth_in_view", "moon_in_view")
+
+
+def camera_fov(lens, sensor_width, resolution):
+    """ half field of view angles of a camera with automatic sensor fit
+    Args:
+        - lens: focal length in mm
+        - sensor_width: sensor size in mm along the larger image dimension
+        - resolution: image (width, height) in pixels
+    Returns:
+        - (half_fov_x, half_fov_y) in radians
+    """
+    width, height = resolution
+    half_tan = sensor_width / 2 / lens
+    if width >= height:
+        return np.arctan(half_tan), np.arctan(half_tan * height / width)
+    return np.arctan(half_tan * width / height), np.arctan(half_tan)
+
+
+def sun_occluded(sun, bodies, point=(0, 0, 0)):
+    """ check if the sun centre is hidden behind any body as seen from a point
+    Args:
+        - sun: (D, 4) ephemeris rows of the sun (radius, x, y, z)
+        - bodies: list of (D, 4) ephemeris rows of occluding bodies
+        - point: observer position, the station is at the origin
+    Returns:
+        - (D,) bool array
+    """
+    to_sun = sun[:, 1:] - np.asarray(point)
+    sun_dist = np.linalg.norm(to_sun, axis=1)
+    direction = to_sun / sun_dist[:, None]
+    occluded = np.zeros(len(sun), dtype=bool)
+    for body in bodies:
+        centre = body[:, 1:] - np.asarray(point)
+        t = np.sum(centre * direction, axis=1)  # distance along the line of sight to the sun
+        miss = np.linalg.norm(centre - t[:, None] * direction, axis=1)
+        occluded |= (t > 0) & (t < sun_dist) & (miss < body[:, 0])
+    return occluded
+
+
+def sphere_in_view(body, cam_poses, half_fov, margin=0.0, clip_end=np.inf):
+    """ check if a sphere is at least partly inside the frustum of each camera
+    Args:
+        - body: (D, 4) ephemeris rows (radius, x, y, z)
+        - cam_poses: (C, 7) camera table rows (camera index, x,y,z, roll, pitch, yaw)
+        - half_fov: (half_fov_x, half_fov_y) in radians from camera_fov
+        - margin: angle in radians added to the field of view, covers the camera pose noise
+        - clip_end: camera far clipping distance
+    Returns:
+        - (D, C) bool array
+    """
+    rot = np.stack([rotation_matrix_from_euler(pose[4:7]) for pose in cam_poses])
+    rel = body[:, None, 1:] - cam_poses[None, :, 1:4]  # (D, C, 3)
+    local = np.einsum("cji,dcj->dci", rot, rel)  # camera coordinates, camera looks along -z
+    forward = -local[..., 2]
+    dist = np.linalg.norm(rel, axis=-1)
+    # angular radius of the sphere, cameras inside the sphere see it everywhere
+    radius = body[:, None, 0]
+    angular = np.arcsin(np.clip(radius / np.maximum(dist, 1e-9), 0, 1))
+    in_x = np.arctan2(np.abs(local[..., 0]), forward) < half_fov[0] + angular + margin
+    in_y = np.arctan2(np.abs(local[..., 1]), forward) < half_fov[1] + angular + margin
+    return in_x & in_y & (dist - radius < clip_end)
+
+
+def classify_visibility(ephemeris, cam_poses, half_fov, margin=0.0, clip_end=np.inf, days=None):
+    """ classify every (day, camera) of the ephemeris before rendering
+    Args:
+        - ephemeris: dictionary of moon, sun and earth ephemeris data from load_ephemeris
+        - cam_poses: (C, 7) camera table rows (camera index, x,y,z, roll, pitch, yaw)
+        - half_fov: (half_fov_x, half_fov_y) in radians from camera_fov
+        - margin: angle in radians added to the field of view, covers the camera pose noise
+        - clip_end: camera far clipping distance
+        - days: ephemeris rows to classify, None classifies all rows, other rows
+            (such as the invalid row 0) get no flags
+    Returns:
+        - dictionary of VISIBILITY_FLAGS to (D, C) bool arrays indexed by day, the
+            eclipse is evaluated at the station and is the same for all cameras
+    """
+    n_days = len(ephemeris["sun"])
+    days = np.arange(n_days) if days is None else np.asarray(days)
+    moon, sun, earth = (ephemeris[body][days] for body in ("moon", "sun", "earth"))
+    eclipse = sun_occluded(sun, [earth, moon])
+    flags = {
+        "eclipse": np.repeat(eclipse[:, None], len(cam_poses), axis=1),
+        "sun_in_view": sphere_in_view(sun, cam_poses, half_fov, margin, clip_end),
+        "earth_in_view": sphere_in_view(earth, cam_poses, half_fov, margin, clip_end),
+        "moon_in_view": sphere_in_view(moon, cam_poses, half_fov, margin, clip_end),
+    }
+    visibility = {}
+    for flag, values in flags.items():
+        visibility[flag] = np.zeros((n_days, len(cam_poses)), dtype=bool)
+        visibility[flag][days] = values
+    return visibility
+
+
+def visibility_tags(visibility, day, cam):
+    """ names of the visibility flags set for a day and camera column """
+    return [flag for flag in VISIBILITY_FLAGS if visibility[flag][day, cam]]